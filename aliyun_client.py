@@ -1,17 +1,62 @@
 import logging
-from typing import Optional, Dict
-from alibabacloud_agency20221216.client import Client as AgencyClient
-from alibabacloud_tea_openapi import models as open_api_models
-from alibabacloud_agency20221216 import models as agency_models
-from alibabacloud_tea_util import models as util_models
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Tuple
+from Tea.exceptions import TeaException, UnretryableException
 from config import Config
 
 logger = logging.getLogger(__name__)
 
+# 传给SDK的空闲连接数上限。Tea 0.4.x 按主机复用自己的连接池，不读取该值
+# 和 keep_alive，实际生效的只有超时设置
+MAX_IDLE_CONNS = 32
+
+# 后台刷新缓存时同时进行的最大请求数，避免大量缓存同时过期时触发限流
+MAX_REFRESH_WORKERS = 4
+
+# 阿里云错误码（"."之前的部分）到提示信息的映射
+_ERROR_MESSAGES = {
+    "Forbidden": "权限不足，请检查AK/SK是否有权限",
+    "AccessDenied": "权限不足，请检查AK/SK是否有权限",
+    "InvalidParameter": "用户UID不存在或无效",
+    "UserNotFound": "用户UID不存在或无效",
+    "Throttling": "请求频率过高，请稍后重试",
+    "SignatureDoesNotMatch": "签名验证失败，请检查AK/SK是否正确",
+}
+# 无法取得错误码时（非TeaException），按错误信息中的关键字依次匹配
+_ERROR_MAP = tuple(_ERROR_MESSAGES.items())
+
+# 阿里云UID为纯数字，超过该长度的输入直接视为无效
+MAX_UID_LENGTH = 20
+
+# 不指定UID查询GetAccountInfo时必须提供用户类型
+_PROBE_USER_TYPE = "1"
+
+
+def is_valid_uid(uid: str) -> bool:
+    """检查UID格式（纯ASCII数字），避免无效输入触发API调用"""
+    return uid.isascii() and uid.isdigit() and len(uid) <= MAX_UID_LENGTH
+
 
 class AliyunClient:
+    # 阿里云SDK在首次初始化客户端时才导入，未配置凭证时无需加载
+    _agency_models = None
+
     def __init__(self):
         self.client = None
+        self.configured = False
+        self._runtime = None
+        # 信用信息缓存: uid -> (查询时间, 结果)
+        self._cache: Dict[str, Tuple[float, Dict]] = {}
+        self._refreshing = set()
+        self._cache_lock = threading.Lock()
+        # 凭证代次，每次更换凭证递增，旧凭证查询到的结果不再写入缓存
+        self._generation = 0
+        self._last_prune = time.monotonic()
+        self._refresh_executor = ThreadPoolExecutor(
+            max_workers=MAX_REFRESH_WORKERS, thread_name_prefix="credit-refresh"
+        )
         self._init_client()
 
     def _init_client(self):
@@ -21,37 +66,97 @@ class AliyunClient:
             return
 
         try:
+            from alibabacloud_agency20221216 import models as agency_models
+            from alibabacloud_agency20221216.client import Client as AgencyClient
+            from alibabacloud_tea_openapi import models as open_api_models
+            from alibabacloud_tea_util import models as util_models
+
+            AliyunClient._agency_models = agency_models
+
             config = open_api_models.Config(
                 access_key_id=Config.ALIYUN_ACCESS_KEY_ID,
                 access_key_secret=Config.ALIYUN_ACCESS_KEY_SECRET,
                 endpoint="agency.aliyuncs.com",
+                connect_timeout=Config.ALIYUN_CONNECT_TIMEOUT,
+                read_timeout=Config.ALIYUN_READ_TIMEOUT,
+                max_idle_conns=MAX_IDLE_CONNS,
             )
             self.client = AgencyClient(config)
+            # 运行时参数在客户端生命周期内不变，只构造一次
+            self._runtime = util_models.RuntimeOptions(
+                autoretry=False,
+                keep_alive=True,
+                max_idle_conns=MAX_IDLE_CONNS,
+                connect_timeout=Config.ALIYUN_CONNECT_TIMEOUT,
+                read_timeout=Config.ALIYUN_READ_TIMEOUT,
+            )
             logger.info("阿里云客户端初始化成功")
         except Exception as e:
-            logger.error(f"阿里云客户端初始化失败: {e}")
+            logger.error("阿里云客户端初始化失败: %s", e)
             self.client = None
+        self.configured = self.client is not None
 
     def set_credentials(self, access_key_id: str, access_key_secret: str):
         """设置阿里云凭证并重新初始化客户端"""
         Config.set_aliyun_credentials(access_key_id, access_key_secret)
         self._init_client()
+        # 在新客户端就绪后再更换代次，之前发起的查询结果都会被丢弃
+        with self._cache_lock:
+            self._generation += 1
+            self._cache.clear()
 
-    def get_credit_info(self, uid: str) -> Optional[Dict]:
+    def get_credit_info(self, uid: str, force: bool = False) -> Optional[Dict]:
         """获取指定UID的信用信息
 
-        使用阿里云Agency OpenAPI的GetAccountInfo接口获取账户信息
+        结果在 CREDIT_CACHE_TTL 秒内直接返回缓存；超过后、CREDIT_CACHE_STALE
+        秒内仍返回缓存，同时在后台刷新。force=True 时跳过缓存直接查询。
+        来自缓存的结果带有 cached=True，调用方不应将其作为最新余额保存。
         """
         if not self.client:
             logger.error("阿里云客户端未初始化")
             return None
 
+        if not is_valid_uid(uid):
+            return {"uid": uid, "success": False, "error": "UID格式无效"}
+
+        if not force:
+            cached = self._cache.get(uid)
+            if cached:
+                cached_at, result = cached
+                age = time.monotonic() - cached_at
+                if age < Config.CREDIT_CACHE_TTL:
+                    return dict(result, cached=True)
+                if age < Config.CREDIT_CACHE_STALE:
+                    self._schedule_refresh(uid)
+                    return dict(result, cached=True)
+
+        return self._query_credit_info(uid)
+
+    def _schedule_refresh(self, uid: str):
+        """在后台线程池中刷新缓存，同一UID同时只刷新一次"""
+        with self._cache_lock:
+            if uid in self._refreshing:
+                return
+            self._refreshing.add(uid)
+        self._refresh_executor.submit(self._refresh, uid)
+
+    def _refresh(self, uid: str):
+        try:
+            self._query_credit_info(uid)
+        finally:
+            with self._cache_lock:
+                self._refreshing.discard(uid)
+
+    def _query_credit_info(self, uid: str) -> Dict:
+        """调用阿里云Agency OpenAPI的GetAccountInfo接口获取账户信息"""
+        # 先记录代次再取客户端，保证写缓存时能识别出凭证已更换
+        generation = self._generation
+        client = self.client
         try:
-            request = agency_models.GetAccountInfoRequest(uid=int(uid))
-            logger.info(f"开始查询UID {uid} 的账户信息")
+            request = self._agency_models.GetAccountInfoRequest(uid=int(uid))
+            logger.info("开始查询UID %s 的账户信息", uid)
 
-            runtime = util_models.RuntimeOptions()
-            response = self.client.get_account_info_with_options(request, runtime)
+            response = client.get_account_info_with_options(request, self._runtime)
 
             if response.status_code == 200 and response.body:
                 account_info = response.body.account_info_list.account_info[0]
@@ -64,12 +169,18 @@ class AliyunClient:
                 }
 
                 logger.info(
-                    f"成功获取UID {uid} 的账户信息: 可用余额={result['available_credit']:.2f}"
+                    "成功获取UID %s 的账户信息: 可用余额=%.2f",
+                    uid,
+                    result["available_credit"],
                 )
+                self._store_result(uid, result, generation)
                 return result
             else:
                 logger.error(
-                    f"获取UID {uid} 账户信息失败: HTTP {response.status_code} - {response.body.message}"
+                    "获取UID %s 账户信息失败: HTTP %s - %s",
+                    uid,
+                    response.status_code,
+                    response.body.message,
                 )
                 return {
                     "uid": uid,
@@ -77,49 +188,93 @@ class AliyunClient:
                     "error": f"HTTP {response.status_code} - {response.body.message}",
                 }
 
+        # UnretryableException 是 TeaException 的子类，必须先捕获
+        except UnretryableException as e:
+            logger.error("调用GetAccountInfo API网络异常 (UID: %s): %s", uid, e)
+            return {"uid": uid, "success": False, "error": f"网络异常: {e}"}
+
+        except TeaException as e:
+            logger.error(
+                "调用GetAccountInfo API失败 (UID: %s): %s - %s", uid, e.code, e.message
+            )
+            code = (e.code or "").split(".", 1)[0]
+            error_type = _ERROR_MESSAGES.get(code, f"未知错误: {e.message}")
+            return {"uid": uid, "success": False, "error": error_type}
+
         except Exception as e:
             error_msg = str(e)
-            logger.error(f"调用GetAccountInfo API失败 (UID: {uid}): {error_msg}")
-
-            if "Forbidden" in error_msg or "AccessDenied" in error_msg:
-                error_type = "权限不足，请检查AK/SK是否有权限"
-            elif "InvalidParameter" in error_msg or "UserNotFound" in error_msg:
-                error_type = "用户UID不存在或无效"
-            elif "Throttling" in error_msg:
-                error_type = "请求频率过高，请稍后重试"
-            elif "SignatureDoesNotMatch" in error_msg:
-                error_type = "签名验证失败，请检查AK/SK是否正确"
-            else:
-                error_type = f"未知错误: {error_msg}"
+            logger.error("调用GetAccountInfo API失败 (UID: %s): %s", uid, error_msg)
+
+            error_type = next(
+                (label for needle, label in _ERROR_MAP if needle in error_msg),
+                f"未知错误: {error_msg}",
+            )
 
             return {"uid": uid, "success": False, "error": error_type}
 
+    def _store_result(self, uid: str, result: Dict, generation: int):
+        """写入缓存，并定期清理超过 CREDIT_CACHE_STALE 的条目（如已解绑的UID）"""
+        now = time.monotonic()
+        with self._cache_lock:
+            if generation != self._generation:
+                return
+            self._cache[uid] = (now, result)
+            if now - self._last_prune < Config.CREDIT_CACHE_STALE:
+                return
+            self._last_prune = now
+            expired = [
+                key
+                for key, (cached_at, _) in self._cache.items()
+                if now - cached_at >= Config.CREDIT_CACHE_STALE
+            ]
+            for key in expired:
+                del self._cache[key]
+
     def test_connection(self) -> bool:
         """测试阿里云连接"""
         if not self.client:
             return False
 
         # 如果提供了测试UID，则用GetAccountInfo验证
-        test_uid = getattr(Config, "ALIYUN_RESELLER_TEST_UID", None)
+        test_uid = Config.ALIYUN_RESELLER_TEST_UID
         if test_uid:
-            try:
-                result = self.get_credit_info(test_uid)
-                if result and result.get("success"):
-                    logger.info("凭证验证成功（GetAccountInfo）")
-                    return True
-                else:
-                    logger.error(
-                        f"凭证验证失败（GetAccountInfo）: {result.get('error') if result else 'unknown'}"
-                    )
-                    return False
-            except Exception as e:
-                logger.error(f"凭证验证异常（GetAccountInfo）: {e}")
-                return False
-
-        # 如果没有测试UID，只检查客户端是否初始化成功
-        logger.warning("未配置测试UID，无法验证凭证有效性")
-        return True
+            # get_credit_info 自行处理所有异常，这里只需判断结果
+            result = self.get_credit_info(test_uid, force=True)
+            if result and result.get("success"):
+                logger.info("凭证验证成功（GetAccountInfo）")
+                return True
+            logger.error(
+                "凭证验证失败（GetAccountInfo）: %s",
+                result.get("error") if result else "unknown",
+            )
+            return False
+
+        # 如果没有测试UID，用不带UID的分页查询做一次轻量验证
+        return self._lightweight_probe()
+
+    def _lightweight_probe(self) -> bool:
+        """不指定UID调用GetAccountInfo（仅取1条），验证凭证是否可用
+
+        只把阿里云返回的错误视为凭证无效，其他异常（如参数错误）直接抛出。
+        """
+        request = self._agency_models.GetAccountInfoRequest(
+            current_page=1, page_size=1, user_type=_PROBE_USER_TYPE
+        )
+        try:
+            response = self.client.get_account_info_with_options(
+                request, self._runtime
+            )
+            if response.status_code == 200:
+                logger.info("凭证验证成功（GetAccountInfo 轻量查询）")
+                return True
+            logger.error(
+                "凭证验证失败（GetAccountInfo 轻量查询）: HTTP %s", response.status_code
+            )
+            return False
+        except TeaException as e:
+            logger.error("凭证验证失败（GetAccountInfo 轻量查询）: %s", e)
+            return False
 
     def is_configured(self) -> bool:
         """检查是否已配置阿里云凭证"""
-        return self.client is not None
+        return self.configured
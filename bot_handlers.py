@@ -1,15 +1,103 @@
+import asyncio
 import logging
+from typing import Optional
 from telegram import Update
 from telegram.ext import ContextTypes
 from database import Database
-from aliyun_client import AliyunClient
+from aliyun_client import AliyunClient, is_valid_uid
 from monitor import BalanceMonitor
 from config import Config
 from datetime import datetime
+import math
 import re
 
 logger = logging.getLogger(__name__)
 
+# 批量查询余额时的最大并发请求数
+CREDIT_QUERY_CONCURRENCY = 8
+
+# 凭证格式: AK:xxx 与 SK:xxx，以空白（通常为换行）分隔
+_CREDENTIALS_RE = re.compile(r"AK:([A-Za-z0-9]+)\s+SK:([A-Za-z0-9]+)")
+
+# Telegram 单条消息上限为4096字符，留出余量
+MESSAGE_CHUNK_LIMIT = 4000
+
+_MAIN_MENU = (
+    " 阿里云余额监控机器人\n\n"
+    " 可用命令：\n"
+    "/bind_aliyun `[UID] [备注] [低余额阈值] [突降阈值]` - 绑定阿里云账号\n"
+    "/unbind_aliyun [UID] - 解绑阿里云账号\n"
+    "/list_aliyun - 查看绑定列表\n"
+    "/aliyun_balance - 查询所有账号余额\n"
+    "/set_aliyun_drop [UID] [新突降阈值] - 设置突降阈值\n"
+    "/set_aliyun_low [UID] [新低余额阈值] - 设置低余额阈值\n"
+    "/monitor_status - 查看监控状态\n"
+    "/start_monitor - 启动监控\n"
+    "/stop_monitor - 停止监控\n"
+    "/help - 显示帮助信息"
+)
+
+# 账号列表 / 余额查询结果中每个账号的展示模板
+_LIST_ROW = (
+    "{i}. {remark} ({uid})\n"
+    "   余额: ¥{last_balance:.2f}\n"
+    "   低余额阈值: ¥{low_balance_threshold:.2f}\n"
+    "   突降阈值: ¥{drop_threshold:.2f}\n"
+    "   更新时间: {updated_at}\n"
+)
+_BALANCE_ROW = (
+    "{status} {i}. {remark} ({uid})\n"
+    "   余额: ¥{balance:.2f}\n"
+    "   信用额度: ¥{credit_line:.2f}\n"
+)
+_BALANCE_ERROR_ROW = " {i}. {remark} ({uid})\n   查询失败: {error}\n"
+
+_CREDENTIALS_PROMPT = (
+    "🔧 首次使用需要配置阿里云凭证。\n"
+    "请发送您的阿里云 Access Key ID 和 Access Key Secret，格式如下：\n\n"
+    "`AK:您的AccessKeyID`\n"
+    "`SK:您的AccessKeySecret`\n\n"
+    "例如：\n"
+    "`AK:LTAI4GxxxxxxxxxxxxxxxxxxxxG`\n"
+    "`SK:xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx`\n\n"
+    "⚠️ 请确保在私聊中发送，避免泄露凭证！"
+)
+
+
+async def _db(fn, *args):
+    """在线程池中执行数据库操作，避免SQLite的磁盘IO阻塞事件循环"""
+    return await asyncio.to_thread(fn, *args)
+
+
+def _parse_threshold(value: str) -> Optional[float]:
+    """解析阈值参数，非数字、负数、NaN或无穷大时返回None"""
+    try:
+        threshold = float(value)
+    except ValueError:
+        return None
+    return threshold if math.isfinite(threshold) and threshold >= 0 else None
+
+
+async def _send_long(update: Update, text: str, limit: int = MESSAGE_CHUNK_LIMIT):
+    """发送长消息，超过 limit 时在账号块（空行）边界处拆分为多条依次发送"""
+    parts = []
+    current = ""
+    for block in text.split("\n\n"):
+        if current and len(current) + 2 + len(block) > limit:
+            parts.append(current)
+            current = ""
+        current = f"{current}\n\n{block}" if current else block
+        # 单个块本身超长时只能硬切
+        while len(current) > limit:
+            parts.append(current[:limit])
+            current = current[limit:]
+    if current:
+        parts.append(current)
+
+    # 按顺序发送，避免乱序并降低触发Telegram限流的风险
+    for part in parts:
+        await update.message.reply_text(part)
+
 
 class BotHandlers:
     def __init__(
@@ -18,7 +106,8 @@ class BotHandlers:
         self.db = db
         self.aliyun_client = aliyun_client
         self.monitor = monitor
-        self.waiting_for_credentials = {}  # 存储等待输入凭证的用户
+        self.waiting_for_credentials: set[int] = set()  # 等待输入凭证的用户
+        self._credit_query_semaphore = asyncio.Semaphore(CREDIT_QUERY_CONCURRENCY)
 
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """处理 /start 命令 - 所有用户都可以使用"""
@@ -35,18 +124,9 @@ class BotHandlers:
         if Config.is_admin(chat_id):
             # 管理员用户的完整功能
             if not self.aliyun_client.is_configured():
-                welcome_text += (
-                    "🔧 首次使用需要配置阿里云凭证。\n"
-                    "请发送您的阿里云 Access Key ID 和 Access Key Secret，格式如下：\n\n"
-                    "`AK:您的AccessKeyID`\n"
-                    "`SK:您的AccessKeySecret`\n\n"
-                    "例如：\n"
-                    "`AK:LTAI4GxxxxxxxxxxxxxxxxxxxxG`\n"
-                    "`SK:xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx`\n\n"
-                    "⚠️ 请确保在私聊中发送，避免泄露凭证！"
-                )
+                welcome_text += _CREDENTIALS_PROMPT
                 await update.message.reply_text(welcome_text, parse_mode="Markdown")
-                self.waiting_for_credentials[chat_id] = True
+                self.waiting_for_credentials.add(chat_id)
             else:
                 await update.message.reply_text(welcome_text, parse_mode="Markdown")
                 await self._show_main_menu(update)
@@ -79,10 +159,9 @@ class BotHandlers:
             return
 
         # 解析AK和SK
-        ak_match = re.search(r"AK:([A-Za-z0-9]+)", text)
-        sk_match = re.search(r"SK:([A-Za-z0-9]+)", text)
+        match = _CREDENTIALS_RE.search(text)
 
-        if not ak_match or not sk_match:
+        if not match:
             await update.message.reply_text(
                 " 格式错误！请按照以下格式发送：\n\n"
                 "`AK:您的AccessKeyID`\n"
@@ -91,20 +170,20 @@ class BotHandlers:
             )
             return
 
-        access_key_id = ak_match.group(1)
-        access_key_secret = sk_match.group(1)
+        access_key_id, access_key_secret = match.groups()
 
-        # 设置凭证
-        self.aliyun_client.set_credentials(access_key_id, access_key_secret)
+        def _configure() -> bool:
+            # 设置凭证（首次会导入阿里云SDK）并测试连接，都在线程池中执行
+            self.aliyun_client.set_credentials(access_key_id, access_key_secret)
+            return self.aliyun_client.test_connection()
 
-        # 测试连接
-        if self.aliyun_client.test_connection():
+        if await asyncio.to_thread(_configure):
             await update.message.reply_text(" 阿里云凭证配置成功！")
-            del self.waiting_for_credentials[chat_id]
+            self.waiting_for_credentials.discard(chat_id)
 
             # 保存凭证到数据库（加密存储）
-            self.db.set_config("aliyun_ak", access_key_id)
-            self.db.set_config("aliyun_sk", access_key_secret)
+            await _db(self.db.set_config, "aliyun_ak", access_key_id)
+            await _db(self.db.set_config, "aliyun_sk", access_key_secret)
 
             await self._show_main_menu(update)
 
@@ -115,36 +194,27 @@ class BotHandlers:
         else:
             await update.message.reply_text(" 阿里云凭证验证失败（已设权限），请检查后重新输入")
 
+    async def _guard(self, update: Update, require_aliyun: bool = False) -> bool:
+        """检查管理员权限（以及可选的阿里云凭证配置），不满足时回复提示"""
+        if not Config.is_admin(update.effective_chat.id):
+            await update.message.reply_text(" 您没有权限使用此命令")
+            return False
+
+        if require_aliyun and not self.aliyun_client.is_configured():
+            await update.message.reply_text(" 请先配置阿里云凭证")
+            return False
+
+        return True
+
     async def _show_main_menu(self, update: Update):
         """显示主菜单"""
-        menu_text = (
-            " 阿里云余额监控机器人\n\n"
-            " 可用命令：\n"
-            "/bind_aliyun `[UID] [备注] [低余额阈值] [突降阈值]` - 绑定阿里云账号\n"
-            "/unbind_aliyun [UID] - 解绑阿里云账号\n"
-            "/list_aliyun - 查看绑定列表\n"
-            "/aliyun_balance - 查询所有账号余额\n"
-            "/set_aliyun_drop [UID] [新突降阈值] - 设置突降阈值\n"
-            "/set_aliyun_low [UID] [新低余额阈值] - 设置低余额阈值\n"
-            "/monitor_status - 查看监控状态\n"
-            "/start_monitor - 启动监控\n"
-            "/stop_monitor - 停止监控\n"
-            "/help - 显示帮助信息"
-        )
-        await update.message.reply_text(menu_text)
+        await update.message.reply_text(_MAIN_MENU)
 
     async def bind_aliyun_command(
         self, update: Update, context: ContextTypes.DEFAULT_TYPE
     ):
         """处理 /bind_aliyun 命令"""
-        chat_id = update.effective_chat.id
-
-        if not Config.is_admin(chat_id):
-            await update.message.reply_text(" 您没有权限使用此命令")
-            return
-
-        if not self.aliyun_client.is_configured():
-            await update.message.reply_text(" 请先配置阿里云凭证")
+        if not await self._guard(update, require_aliyun=True):
             return
 
         args = context.args
@@ -160,15 +230,20 @@ class BotHandlers:
 
         uid, remark, low_threshold_str, drop_threshold_str = args
 
-        try:
-            low_threshold = float(low_threshold_str)
-            drop_threshold = float(drop_threshold_str)
-        except ValueError:
-            await update.message.reply_text(" 阈值必须是数字")
+        if not is_valid_uid(uid):
+            await update.message.reply_text(" UID必须为纯数字")
+            return
+
+        low_threshold = _parse_threshold(low_threshold_str)
+        drop_threshold = _parse_threshold(drop_threshold_str)
+        if low_threshold is None or drop_threshold is None:
+            await update.message.reply_text(" 阈值必须是非负数字")
             return
 
         # 验证UID是否有效
-        credit_info = self.aliyun_client.get_credit_info(uid)
+        credit_info = await asyncio.to_thread(
+            self.aliyun_client.get_credit_info, uid, force=True
+        )
         if not credit_info or not credit_info.get("success"):
             await update.message.reply_text(
                 f" 无法获取UID {uid} 的信息，请检查UID是否正确，或是否有权限"
@@ -176,10 +251,16 @@ class BotHandlers:
             return
 
         # 绑定账号
-        if self.db.bind_aliyun_account(uid, remark, low_threshold, drop_threshold):
+        bound = await _db(
+            self.db.bind_aliyun_account, uid, remark, low_threshold, drop_threshold
+        )
+        if bound:
+            # 重新绑定的账号不沿用之前的失败退避和历史写入记录
+            self.monitor.forget_account(uid)
+
             # 更新初始余额
             current_balance = credit_info["available_credit"]
-            self.db.update_balance(uid, current_balance)
+            await _db(self.db.update_balance, uid, current_balance)
 
             await update.message.reply_text(
                 f" 绑定成功！\n\n"
@@ -196,10 +277,7 @@ class BotHandlers:
         self, update: Update, context: ContextTypes.DEFAULT_TYPE
     ):
         """处理 /unbind_aliyun 命令"""
-        chat_id = update.effective_chat.id
-
-        if not Config.is_admin(chat_id):
-            await update.message.reply_text(" 您没有权限使用此命令")
+        if not await self._guard(update):
             return
 
         args = context.args
@@ -215,7 +293,12 @@ class BotHandlers:
 
         uid = args[0]
 
-        if self.db.unbind_aliyun_account(uid):
+        if not is_valid_uid(uid):
+            await update.message.reply_text(" UID必须为纯数字")
+            return
+
+        if await _db(self.db.unbind_aliyun_account, uid):
+            self.monitor.forget_account(uid)
             await update.message.reply_text(f" 已解绑UID: {uid}")
         else:
             await update.message.reply_text(f" 解绑失败，UID {uid} 可能不存在")
@@ -224,47 +307,29 @@ class BotHandlers:
         self, update: Update, context: ContextTypes.DEFAULT_TYPE
     ):
         """处理 /list_aliyun 命令"""
-        chat_id = update.effective_chat.id
-
-        if not Config.is_admin(chat_id):
-            await update.message.reply_text(" 您没有权限使用此命令")
+        if not await self._guard(update):
             return
 
-        accounts = self.db.get_aliyun_accounts()
+        accounts = await _db(self.db.get_aliyun_accounts)
 
         if not accounts:
             await update.message.reply_text(" 暂无绑定的阿里云账号")
             return
 
-        message_lines = [" 阿里云账号列表：\n"]
-
-        for i, account in enumerate(accounts, 1):
-            message_lines.append(
-                f"{i}. {account['remark']} ({account['uid']})\n"
-                f"   余额: ¥{account['last_balance']:.2f}\n"
-                f"   低余额阈值: ¥{account['low_balance_threshold']:.2f}\n"
-                f"   突降阈值: ¥{account['drop_threshold']:.2f}\n"
-                f"   更新时间: {account['updated_at']}\n"
-            )
-
-        message = "\n".join(message_lines)
-        await update.message.reply_text(message)
+        body = "\n".join(
+            _LIST_ROW.format(i=i, **account) for i, account in enumerate(accounts, 1)
+        )
+        message = f" 阿里云账号列表：\n\n{body}"
+        await _send_long(update, message)
 
     async def aliyun_balance_command(
         self, update: Update, context: ContextTypes.DEFAULT_TYPE
     ):
         """处理 /aliyun_balance 命令"""
-        chat_id = update.effective_chat.id
-
-        if not Config.is_admin(chat_id):
-            await update.message.reply_text(" 您没有权限使用此命令")
-            return
-
-        if not self.aliyun_client.is_configured():
-            await update.message.reply_text(" 请先配置阿里云凭证")
+        if not await self._guard(update, require_aliyun=True):
             return
 
-        accounts = self.db.get_aliyun_accounts()
+        accounts = await _db(self.db.get_aliyun_accounts)
 
         if not accounts:
             await update.message.reply_text(" 暂无绑定的阿里云账号")
@@ -272,18 +337,27 @@ class BotHandlers:
 
         await update.message.reply_text(" 正在查询余额，请稍候...")
 
+        async def _fetch(account):
+            async with self._credit_query_semaphore:
+                return await asyncio.to_thread(
+                    self.aliyun_client.get_credit_info, account["uid"]
+                )
+
+        # 并发查询所有账号，结果顺序与 accounts 一致
+        results = await asyncio.gather(*[_fetch(account) for account in accounts])
+
         message_lines = [" 阿里云账号余额：\n"]
+        balance_updates = []
 
-        for i, account in enumerate(accounts, 1):
+        for i, (account, credit_info) in enumerate(zip(accounts, results), 1):
             uid = account["uid"]
             remark = account["remark"]
 
-            credit_info = self.aliyun_client.get_credit_info(uid)
-
             if credit_info and credit_info.get("success"):
                 balance = credit_info["available_credit"]
-                # 更新数据库中的余额
-                self.db.update_balance(uid, balance)
+                # 缓存结果可能已过期，只保存实时查询到的余额
+                if not credit_info.get("cached"):
+                    balance_updates.append((uid, balance))
 
                 status = "🟢"
                 if balance <= account["low_balance_threshold"]:
@@ -292,27 +366,32 @@ class BotHandlers:
                     status = "🟡"
 
                 message_lines.append(
-                    f"{status} {i}. {remark} ({uid})\n"
-                    f"   余额: ¥{balance:.2f}\n"
-                    f"   信用额度: ¥{credit_info.get('credit_line', 0):.2f}\n"
+                    _BALANCE_ROW.format(
+                        status=status,
+                        i=i,
+                        remark=remark,
+                        uid=uid,
+                        balance=balance,
+                        credit_line=credit_info.get("credit_line", 0),
+                    )
                 )
             else:
+                error = credit_info.get("error", "未知错误") if credit_info else "网络错误"
                 message_lines.append(
-                    f" {i}. {remark} ({uid})\n"
-                    f"   查询失败: {credit_info.get('error', '未知错误') if credit_info else '网络错误'}\n"
+                    _BALANCE_ERROR_ROW.format(i=i, remark=remark, uid=uid, error=error)
                 )
 
+        # 一次性更新数据库中的余额
+        await _db(self.db.update_balances, balance_updates)
+
         message = "\n".join(message_lines)
-        await update.message.reply_text(message)
+        await _send_long(update, message)
 
     async def set_aliyun_drop_command(
         self, update: Update, context: ContextTypes.DEFAULT_TYPE
     ):
         """处理 /set_aliyun_drop 命令"""
-        chat_id = update.effective_chat.id
-
-        if not Config.is_admin(chat_id):
-            await update.message.reply_text(" 您没有权限使用此命令")
+        if not await self._guard(update):
             return
 
         args = context.args
@@ -328,13 +407,16 @@ class BotHandlers:
 
         uid, threshold_str = args
 
-        try:
-            threshold = float(threshold_str)
-        except ValueError:
-            await update.message.reply_text(" 阈值必须是数字")
+        if not is_valid_uid(uid):
+            await update.message.reply_text(" UID必须为纯数字")
+            return
+
+        threshold = _parse_threshold(threshold_str)
+        if threshold is None:
+            await update.message.reply_text(" 阈值必须是非负数字")
             return
 
-        if self.db.update_threshold(uid, "drop", threshold):
+        if await _db(self.db.update_threshold, uid, "drop", threshold):
             await update.message.reply_text(
                 f" 已更新UID {uid} 的突降阈值为 ¥{threshold:.2f}"
             )
@@ -345,10 +427,7 @@ class BotHandlers:
         self, update: Update, context: ContextTypes.DEFAULT_TYPE
     ):
         """处理 /set_aliyun_low 命令"""
-        chat_id = update.effective_chat.id
-
-        if not Config.is_admin(chat_id):
-            await update.message.reply_text(" 您没有权限使用此命令")
+        if not await self._guard(update):
             return
 
         args = context.args
@@ -364,13 +443,16 @@ class BotHandlers:
 
         uid, threshold_str = args
 
-        try:
-            threshold = float(threshold_str)
-        except ValueError:
-            await update.message.reply_text(" 阈值必须是数字")
+        if not is_valid_uid(uid):
+            await update.message.reply_text(" UID必须为纯数字")
+            return
+
+        threshold = _parse_threshold(threshold_str)
+        if threshold is None:
+            await update.message.reply_text(" 阈值必须是非负数字")
             return
 
-        if self.db.update_threshold(uid, "low", threshold):
+        if await _db(self.db.update_threshold, uid, "low", threshold):
             await update.message.reply_text(
                 f" 已更新UID {uid} 的低余额阈值为 ¥{threshold:.2f}"
             )
@@ -381,14 +463,11 @@ class BotHandlers:
         self, update: Update, context: ContextTypes.DEFAULT_TYPE
     ):
         """处理 /monitor_status 命令"""
-        chat_id = update.effective_chat.id
-
-        if not Config.is_admin(chat_id):
-            await update.message.reply_text(" 您没有权限使用此命令")
+        if not await self._guard(update):
             return
 
         status = "🟢 运行中" if self.monitor.is_monitoring() else "🔴 已停止"
-        accounts_count = len(self.db.get_aliyun_accounts())
+        accounts_count = len(await _db(self.db.get_aliyun_accounts))
 
         message = (
             f"监控状态\n\n"
@@ -404,14 +483,7 @@ class BotHandlers:
         self, update: Update, context: ContextTypes.DEFAULT_TYPE
     ):
         """处理 /start_monitor 命令"""
-        chat_id = update.effective_chat.id
-
-        if not Config.is_admin(chat_id):
-            await update.message.reply_text(" 您没有权限使用此命令")
-            return
-
-        if not self.aliyun_client.is_configured():
-            await update.message.reply_text(" 请先配置阿里云凭证")
+        if not await self._guard(update, require_aliyun=True):
             return
 
         if self.monitor.is_monitoring():
@@ -425,10 +497,7 @@ class BotHandlers:
         self, update: Update, context: ContextTypes.DEFAULT_TYPE
     ):
         """处理 /stop_monitor 命令"""
-        chat_id = update.effective_chat.id
-
-        if not Config.is_admin(chat_id):
-            await update.message.reply_text(" 您没有权限使用此命令")
+        if not await self._guard(update):
             return
 
         if not self.monitor.is_monitoring():
@@ -1,11 +1,24 @@
+import functools
 import os
-from dotenv import load_dotenv
-from typing import List
+from dotenv import dotenv_values, load_dotenv
+from typing import FrozenSet, List
+
+# 进程启动时已有的环境变量优先于 .env，refresh() 时保持同样的优先级
+_PROCESS_ENV_KEYS = frozenset(os.environ)
 
 # 加载环境变量
 load_dotenv()
 
 
+def _parse_admin_chat_ids() -> FrozenSet[int]:
+    """解析逗号分隔的管理员ID列表"""
+    return frozenset(
+        int(id.strip())
+        for id in os.getenv("ADMIN_CHAT_IDS", "").split(",")
+        if id.strip()
+    )
+
+
 class Config:
     # Telegram Bot配置
     BOT_TOKEN = os.getenv("BOT_TOKEN")
@@ -14,15 +27,14 @@ class Config:
     PROXY_URL = os.getenv("PROXY_URL")
 
     # 管理员配置
-    ADMIN_CHAT_IDS = [
-        int(id.strip())
-        for id in os.getenv("ADMIN_CHAT_IDS", "").split(",")
-        if id.strip()
-    ]
+    ADMIN_CHAT_IDS = _parse_admin_chat_ids()
 
     # 监控配置
     CHECK_INTERVAL = int(os.getenv("CHECK_INTERVAL", 300))
     ENABLE_MONITORING = os.getenv("ENABLE_MONITORING", "true").lower() == "true"
+    # 余额历史写入节流：变化小于该金额且距上次写入不足该秒数时只更新最新余额
+    HISTORY_MIN_DELTA = float(os.getenv("HISTORY_MIN_DELTA", 0.01))
+    HISTORY_MIN_INTERVAL = int(os.getenv("HISTORY_MIN_INTERVAL", 3600))
 
     # 数据库配置
     DATABASE_PATH = os.getenv("DATABASE_PATH", "bot_data.db")
@@ -35,8 +47,14 @@ class Config:
     # 阿里云配置（支持环境变量加载 + 运行时更新）
     ALIYUN_ACCESS_KEY_ID = os.getenv("ALIYUN_ACCESS_KEY_ID")
     ALIYUN_ACCESS_KEY_SECRET = os.getenv("ALIYUN_ACCESS_KEY_SECRET")
-    # 可选：用于凭证验证的分销商测试UID（如果提供，将用其调用GetCreditInfo）
+    # 可选：用于凭证验证的分销商测试UID（如果提供，将用其调用GetAccountInfo）
     ALIYUN_RESELLER_TEST_UID = os.getenv("ALIYUN_RESELLER_TEST_UID")
+    # 阿里云API超时（毫秒），同时用于客户端配置和每次请求的运行时参数
+    ALIYUN_CONNECT_TIMEOUT = int(os.getenv("ALIYUN_CONNECT_TIMEOUT", 3000))
+    ALIYUN_READ_TIMEOUT = int(os.getenv("ALIYUN_READ_TIMEOUT", 5000))
+    # 信用信息缓存：新鲜期内直接使用，过期期内先返回旧值再后台刷新（秒）
+    CREDIT_CACHE_TTL = int(os.getenv("CREDIT_CACHE_TTL", 30))
+    CREDIT_CACHE_STALE = int(os.getenv("CREDIT_CACHE_STALE", 120))
 
     @classmethod
     def set_aliyun_credentials(cls, access_key_id: str, access_key_secret: str):
@@ -50,6 +68,21 @@ class Config:
         return chat_id in cls.ADMIN_CHAT_IDS
 
     @classmethod
+    def refresh(cls):
+        """重新加载 .env 中的Bot配置，并清除配置校验结果缓存
+
+        与导入时的 load_dotenv() 一致，进程环境变量（如Docker传入的）不会被
+        .env 覆盖。目前没有调用方，供修改 .env 后在运行时重新加载使用。
+        """
+        for key, value in dotenv_values().items():
+            if key not in _PROCESS_ENV_KEYS and value is not None:
+                os.environ[key] = value
+        cls.BOT_TOKEN = os.getenv("BOT_TOKEN")
+        cls.ADMIN_CHAT_IDS = _parse_admin_chat_ids()
+        cls.validate_config.cache_clear()
+
+    @classmethod
+    @functools.lru_cache(maxsize=1)
     def validate_config(cls) -> bool:
         """验证配置是否完整"""
         # BOT_TOKEN 和 ADMIN_CHAT_IDS 是必需的
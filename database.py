@@ -1,5 +1,7 @@
 import sqlite3
 import json
+import threading
+from contextlib import contextmanager
 from typing import List, Dict, Optional, Tuple
 from datetime import datetime
 import logging
@@ -7,16 +9,135 @@ from config import Config
 
 logger = logging.getLogger(__name__)
 
+# 运行时使用的SQL语句（建表语句见 init_database）
+_SQL_BIND_ACCOUNT = """
+    INSERT OR REPLACE INTO aliyun_accounts
+    (uid, remark, low_balance_threshold, drop_threshold, updated_at)
+    VALUES (?, ?, ?, ?, ?)
+"""
+_SQL_DELETE_ACCOUNT = "DELETE FROM aliyun_accounts WHERE uid = ?"
+_SQL_DELETE_BALANCE_HISTORY = "DELETE FROM balance_history WHERE uid = ?"
+_SQL_DELETE_ALERT_HISTORY = "DELETE FROM alert_history WHERE uid = ?"
+_SQL_SELECT_ACCOUNTS = """
+    SELECT uid, remark, low_balance_threshold, drop_threshold,
+           last_balance, created_at, updated_at
+    FROM aliyun_accounts
+    ORDER BY created_at DESC
+"""
+_SQL_SELECT_ACCOUNT = """
+    SELECT uid, remark, low_balance_threshold, drop_threshold,
+           last_balance, created_at, updated_at
+    FROM aliyun_accounts WHERE uid = ?
+"""
+_SQL_INSERT_BALANCE_HISTORY = """
+    INSERT INTO balance_history (uid, balance, check_time)
+    VALUES (?, ?, ?)
+"""
+_SQL_UPDATE_LAST_BALANCE = """
+    UPDATE aliyun_accounts
+    SET last_balance = ?, updated_at = ?
+    WHERE uid = ?
+"""
+_SQL_UPDATE_LOW_THRESHOLD = """
+    UPDATE aliyun_accounts
+    SET low_balance_threshold = ?, updated_at = ?
+    WHERE uid = ?
+"""
+_SQL_UPDATE_DROP_THRESHOLD = """
+    UPDATE aliyun_accounts
+    SET drop_threshold = ?, updated_at = ?
+    WHERE uid = ?
+"""
+_SQL_INSERT_ALERT = """
+    INSERT INTO alert_history (uid, alert_type, balance, threshold, message)
+    VALUES (?, ?, ?, ?, ?)
+"""
+_SQL_SET_CONFIG = """
+    INSERT OR REPLACE INTO system_config (key, value, updated_at)
+    VALUES (?, ?, ?)
+"""
+_SQL_GET_CONFIG = "SELECT value FROM system_config WHERE key = ?"
+_SQL_GET_CONFIGS = "SELECT key, value FROM system_config WHERE key IN ({})"
+
 
 class Database:
     def __init__(self, db_path: str = None):
         self.db_path = db_path or Config.DATABASE_PATH
+        # 所有操作复用同一个长连接，由锁保证跨线程访问安全
+        self._lock = threading.RLock()
+        self._conn = self._connect()
+        self._in_transaction = False
+        # 账号列表缓存，绑定/解绑/修改阈值时失效，更新余额时原地更新
+        self._accounts_cache: Optional[List[Dict]] = None
+        # uid -> 缓存中的账号字典，与 _accounts_cache 一同重建
+        self._accounts_index: Dict[str, Dict] = {}
         self.init_database()
 
+    def _connect(self) -> sqlite3.Connection:
+        """打开数据库连接并应用连接级别的PRAGMA设置"""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA cache_size=-20000")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    @contextmanager
+    def _cursor(self):
+        """在共享连接上获取游标，正常退出时提交，出错时回滚
+
+        处于 transaction() 中时不单独提交，由外层事务统一提交或回滚。
+        """
+        with self._lock:
+            if self._in_transaction:
+                yield self._conn.cursor()
+                return
+            try:
+                with self._conn:
+                    yield self._conn.cursor()
+            except Exception:
+                # 写入已回滚，缓存可能与数据库不一致
+                self._accounts_cache = None
+                raise
+
+    @contextmanager
+    def transaction(self):
+        """将多次写入合并到一个事务中，只在结束时提交一次"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._in_transaction = True
+            try:
+                yield
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                self._accounts_cache = None
+                raise
+            finally:
+                self._in_transaction = False
+
+    def close(self):
+        """关闭数据库连接"""
+        with self._lock:
+            self.optimize()
+            self._conn.close()
+
+    def optimize(self):
+        """运行 PRAGMA optimize，让查询规划器使用最新的统计信息"""
+        try:
+            with self._cursor() as cursor:
+                cursor.execute("PRAGMA optimize")
+        except Exception as e:
+            logger.error(f"优化数据库失败: {e}")
+
     def init_database(self):
         """初始化数据库表"""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
+        with self._cursor() as cursor:
+            # WAL模式写入数据库文件，对之后的所有连接持续生效
+            cursor.execute("PRAGMA journal_mode=WAL")
 
             # 创建阿里云账号绑定表
             cursor.execute(
@@ -63,6 +184,33 @@ class Database:
             """
             )
 
+            # 按UID查询/删除历史记录时使用的索引
+            cursor.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_balance_history_uid_time
+                ON balance_history (uid, check_time DESC)
+            """
+            )
+            cursor.execute(
+                """
+                CREATE INDEX IF NOT EXISTS idx_alert_history_uid_time
+                ON alert_history (uid, created_at DESC)
+            """
+            )
+
+            # 写入余额历史时同步更新账号表中的最新余额，每次检查只需一条INSERT
+            cursor.execute(
+                """
+                CREATE TRIGGER IF NOT EXISTS trg_balance_history_sync
+                AFTER INSERT ON balance_history
+                BEGIN
+                    UPDATE aliyun_accounts
+                    SET last_balance = NEW.balance, updated_at = NEW.check_time
+                    WHERE uid = NEW.uid;
+                END
+            """
+            )
+
             # 创建系统配置表
             cursor.execute(
                 """
@@ -74,39 +222,62 @@ class Database:
             """
             )
 
-            conn.commit()
+            # 刷新查询规划器的统计信息，数据没有明显变化时几乎没有开销
+            cursor.execute("PRAGMA optimize")
 
     def bind_aliyun_account(
-        self, uid: str, remark: str, low_threshold: float, drop_threshold: float
+        self,
+        uid: str,
+        remark: str,
+        low_threshold: float,
+        drop_threshold: float,
+        now: Optional[datetime] = None,
     ) -> bool:
         """绑定阿里云账号"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
+            now = now or datetime.now()
+            with self._cursor() as cursor:
                 cursor.execute(
-                    """
-                    INSERT OR REPLACE INTO aliyun_accounts 
-                    (uid, remark, low_balance_threshold, drop_threshold, updated_at)
-                    VALUES (?, ?, ?, ?, ?)
-                """,
-                    (uid, remark, low_threshold, drop_threshold, datetime.now()),
+                    _SQL_BIND_ACCOUNT,
+                    (uid, remark, low_threshold, drop_threshold, now),
                 )
-                conn.commit()
+                self._accounts_cache = None
                 return True
         except Exception as e:
             logger.error(f"绑定阿里云账号失败: {e}")
             return False
 
+    def bind_aliyun_accounts_bulk(
+        self,
+        rows: List[Tuple[str, str, float, float]],
+        now: Optional[datetime] = None,
+    ) -> int:
+        """批量绑定阿里云账号，rows 为 (uid, 备注, 低余额阈值, 突降阈值)，返回写入行数"""
+        if not rows:
+            return 0
+        try:
+            now = now or datetime.now()
+            with self._cursor() as cursor:
+                cursor.executemany(
+                    _SQL_BIND_ACCOUNT,
+                    [(uid, remark, low, drop, now) for uid, remark, low, drop in rows],
+                )
+                self._accounts_cache = None
+                return cursor.rowcount
+        except Exception as e:
+            logger.error(f"批量绑定阿里云账号失败: {e}")
+            return 0
+
     def unbind_aliyun_account(self, uid: str) -> bool:
         """解绑阿里云账号"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("DELETE FROM aliyun_accounts WHERE uid = ?", (uid,))
-                cursor.execute("DELETE FROM balance_history WHERE uid = ?", (uid,))
-                cursor.execute("DELETE FROM alert_history WHERE uid = ?", (uid,))
-                conn.commit()
-                return cursor.rowcount > 0
+            with self._cursor() as cursor:
+                cursor.execute(_SQL_DELETE_ACCOUNT, (uid,))
+                deleted = cursor.rowcount
+                cursor.execute(_SQL_DELETE_BALANCE_HISTORY, (uid,))
+                cursor.execute(_SQL_DELETE_ALERT_HISTORY, (uid,))
+                self._accounts_cache = None
+                return deleted > 0
         except Exception as e:
             logger.error(f"解绑阿里云账号失败: {e}")
             return False
@@ -114,29 +285,15 @@ class Database:
     def get_aliyun_accounts(self) -> List[Dict]:
         """获取所有绑定的阿里云账号"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    """
-                    SELECT uid, remark, low_balance_threshold, drop_threshold,
-                           last_balance, created_at, updated_at
-                    FROM aliyun_accounts
-                    ORDER BY created_at DESC
-                """
-                )
-                rows = cursor.fetchall()
-                return [
-                    {
-                        "uid": row[0],
-                        "remark": row[1],
-                        "low_balance_threshold": row[2],
-                        "drop_threshold": row[3],
-                        "last_balance": row[4],
-                        "created_at": row[5],
-                        "updated_at": row[6],
+            with self._cursor() as cursor:
+                if self._accounts_cache is None:
+                    cursor.execute(_SQL_SELECT_ACCOUNTS)
+                    self._accounts_cache = [dict(row) for row in cursor.fetchall()]
+                    self._accounts_index = {
+                        account["uid"]: account for account in self._accounts_cache
                     }
-                    for row in rows
-                ]
+                # 返回副本，避免调用方修改缓存内容
+                return [dict(account) for account in self._accounts_cache]
         except Exception as e:
             logger.error(f"获取阿里云账号列表失败: {e}")
             return []
@@ -144,89 +301,95 @@ class Database:
     def get_aliyun_account(self, uid: str) -> Optional[Dict]:
         """获取指定的阿里云账号信息"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    """
-                    SELECT uid, remark, low_balance_threshold, drop_threshold,
-                           last_balance, created_at, updated_at
-                    FROM aliyun_accounts WHERE uid = ?
-                """,
-                    (uid,),
-                )
+            with self._cursor() as cursor:
+                cursor.execute(_SQL_SELECT_ACCOUNT, (uid,))
                 row = cursor.fetchone()
-                if row:
-                    return {
-                        "uid": row[0],
-                        "remark": row[1],
-                        "low_balance_threshold": row[2],
-                        "drop_threshold": row[3],
-                        "last_balance": row[4],
-                        "created_at": row[5],
-                        "updated_at": row[6],
-                    }
-                return None
+                return dict(row) if row else None
         except Exception as e:
             logger.error(f"获取阿里云账号信息失败: {e}")
             return None
 
-    def update_balance(self, uid: str, balance: float) -> bool:
-        """更新账号余额"""
+    def update_balance(
+        self, uid: str, balance: float, now: Optional[datetime] = None
+    ) -> bool:
+        """更新账号余额（写入余额历史，由触发器同步账号表的最新余额）
+
+        now 为本次检查时间，批量检查时由调用方传入同一个时间避免重复获取。
+        """
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                # 更新账号表中的最新余额
-                cursor.execute(
-                    """
-                    UPDATE aliyun_accounts
-                    SET last_balance = ?, updated_at = ?
-                    WHERE uid = ?
-                """,
-                    (balance, datetime.now(), uid),
-                )
+            now = now or datetime.now()
+            with self._cursor() as cursor:
+                cursor.execute(_SQL_INSERT_BALANCE_HISTORY, (uid, balance, now))
+                self._update_cached_balances([(uid, balance)], now)
+                return True
+        except Exception as e:
+            logger.error(f"更新余额失败: {e}")
+            return False
 
-                # 记录余额历史
-                cursor.execute(
-                    """
-                    INSERT INTO balance_history (uid, balance)
-                    VALUES (?, ?)
-                """,
-                    (uid, balance),
-                )
+    def update_last_balance_only(
+        self, uid: str, balance: float, now: Optional[datetime] = None
+    ) -> bool:
+        """只更新账号表中的最新余额，不写入余额历史"""
+        try:
+            now = now or datetime.now()
+            with self._cursor() as cursor:
+                cursor.execute(_SQL_UPDATE_LAST_BALANCE, (balance, now, uid))
+                self._update_cached_balances([(uid, balance)], now)
+                return True
+        except Exception as e:
+            logger.error(f"更新最新余额失败: {e}")
+            return False
 
-                conn.commit()
+    def update_balances(
+        self, balances: List[Tuple[str, float]], now: Optional[datetime] = None
+    ) -> bool:
+        """批量更新账号余额，所有写入在同一个事务中完成"""
+        if not balances:
+            return True
+        try:
+            now = now or datetime.now()
+            with self._cursor() as cursor:
+                cursor.executemany(
+                    _SQL_INSERT_BALANCE_HISTORY,
+                    [(uid, balance, now) for uid, balance in balances],
+                )
+                self._update_cached_balances(balances, now)
                 return True
         except Exception as e:
-            logger.error(f"更新余额失败: {e}")
+            logger.error(f"批量更新余额失败: {e}")
             return False
 
-    def update_threshold(self, uid: str, threshold_type: str, value: float) -> bool:
+    def _update_cached_balances(
+        self, balances: List[Tuple[str, float]], now: datetime
+    ):
+        """将余额更新同步到账号列表缓存，避免每次更新后重新查询"""
+        if self._accounts_cache is None:
+            return
+        for uid, balance in balances:
+            account = self._accounts_index.get(uid)
+            if account:
+                account["last_balance"] = balance
+                account["updated_at"] = str(now)
+
+    def update_threshold(
+        self,
+        uid: str,
+        threshold_type: str,
+        value: float,
+        now: Optional[datetime] = None,
+    ) -> bool:
         """更新阈值"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
+            now = now or datetime.now()
+            with self._cursor() as cursor:
                 if threshold_type == "low":
-                    cursor.execute(
-                        """
-                        UPDATE aliyun_accounts
-                        SET low_balance_threshold = ?, updated_at = ?
-                        WHERE uid = ?
-                    """,
-                        (value, datetime.now(), uid),
-                    )
+                    cursor.execute(_SQL_UPDATE_LOW_THRESHOLD, (value, now, uid))
                 elif threshold_type == "drop":
-                    cursor.execute(
-                        """
-                        UPDATE aliyun_accounts
-                        SET drop_threshold = ?, updated_at = ?
-                        WHERE uid = ?
-                    """,
-                        (value, datetime.now(), uid),
-                    )
+                    cursor.execute(_SQL_UPDATE_DROP_THRESHOLD, (value, now, uid))
                 else:
                     return False
 
-                conn.commit()
+                self._accounts_cache = None
                 return cursor.rowcount > 0
         except Exception as e:
             logger.error(f"更新阈值失败: {e}")
@@ -237,34 +400,23 @@ class Database:
     ) -> bool:
         """记录告警"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
+            with self._cursor() as cursor:
                 cursor.execute(
-                    """
-                    INSERT INTO alert_history (uid, alert_type, balance, threshold, message)
-                    VALUES (?, ?, ?, ?, ?)
-                """,
-                    (uid, alert_type, balance, threshold, message),
+                    _SQL_INSERT_ALERT, (uid, alert_type, balance, threshold, message)
                 )
-                conn.commit()
                 return True
         except Exception as e:
             logger.error(f"记录告警失败: {e}")
             return False
 
-    def set_config(self, key: str, value: str) -> bool:
+    def set_config(
+        self, key: str, value: str, now: Optional[datetime] = None
+    ) -> bool:
         """设置系统配置"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    """
-                    INSERT OR REPLACE INTO system_config (key, value, updated_at)
-                    VALUES (?, ?, ?)
-                """,
-                    (key, value, datetime.now()),
-                )
-                conn.commit()
+            now = now or datetime.now()
+            with self._cursor() as cursor:
+                cursor.execute(_SQL_SET_CONFIG, (key, value, now))
                 return True
         except Exception as e:
             logger.error(f"设置配置失败: {e}")
@@ -273,11 +425,23 @@ class Database:
     def get_config(self, key: str) -> Optional[str]:
         """获取系统配置"""
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT value FROM system_config WHERE key = ?", (key,))
+            with self._cursor() as cursor:
+                cursor.execute(_SQL_GET_CONFIG, (key,))
                 row = cursor.fetchone()
                 return row[0] if row else None
         except Exception as e:
             logger.error(f"获取配置失败: {e}")
             return None
+
+    def get_configs(self, keys: List[str]) -> Dict[str, str]:
+        """一次查询获取多个系统配置，返回已存在的键值"""
+        if not keys:
+            return {}
+        try:
+            with self._cursor() as cursor:
+                placeholders = ",".join("?" * len(keys))
+                cursor.execute(_SQL_GET_CONFIGS.format(placeholders), list(keys))
+                return {row["key"]: row["value"] for row in cursor.fetchall()}
+        except Exception as e:
+            logger.error(f"获取配置失败: {e}")
+            return {}
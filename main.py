@@ -8,7 +8,6 @@ import logging
 import asyncio
 import signal
 import sys
-from functools import wraps
 from telegram import Update
 from telegram.ext import (
     Application,
@@ -25,36 +24,6 @@ from aliyun_client import AliyunClient
 from monitor import BalanceMonitor
 from bot_handlers import BotHandlers
 
-import nest_asyncio
-from dotenv import load_dotenv
-
-# 只在Windows环境下应用嵌套异步io
-if sys.platform == "win32":
-    nest_asyncio.apply()
-
-# 加载环境变量
-load_dotenv()
-
-# 修复Windows下asyncio事件循环关闭问题
-if sys.platform == "win32":
-    from asyncio.proactor_events import _ProactorBasePipeTransport
-
-    def silence_event_loop_closed(func):
-        @wraps(func)
-        def wrapper(self, *args, **kwargs):
-            try:
-                return func(self, *args, **kwargs)
-            except RuntimeError as e:
-                if str(e) != "Event loop is closed":
-                    raise
-
-        return wrapper
-
-    _ProactorBasePipeTransport.__del__ = silence_event_loop_closed(
-        _ProactorBasePipeTransport.__del__
-    )
-
-
 # 配置日志
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -76,6 +45,9 @@ class AliyunBalanceBot:
         self.monitor = None
         self.handlers = None
         self.running = False
+        self._health_runner = None
+        # 收到停止信号时置位，start() 等待它后再统一清理
+        self._stop_event = asyncio.Event()
 
     async def initialize(self):
         """初始化机器人"""
@@ -93,8 +65,9 @@ class AliyunBalanceBot:
             self.aliyun_client = AliyunClient()
 
             # 尝试从数据库加载凭证
-            saved_ak = self.db.get_config("aliyun_ak")
-            saved_sk = self.db.get_config("aliyun_sk")
+            saved = self.db.get_configs(["aliyun_ak", "aliyun_sk"])
+            saved_ak = saved.get("aliyun_ak")
+            saved_sk = saved.get("aliyun_sk")
             if saved_ak and saved_sk:
                 self.aliyun_client.set_credentials(saved_ak, saved_sk)
                 logger.info("已加载保存的阿里云凭证")
@@ -147,47 +120,30 @@ class AliyunBalanceBot:
 
     def _register_handlers(self):
         """注册命令处理器"""
-        # 命令处理器
-        self.application.add_handler(
-            CommandHandler("start", self.handlers.start_command)
-        )
-        self.application.add_handler(
-            CommandHandler("get_id", self.handlers.get_id_command)
-        )
-        self.application.add_handler(
-            CommandHandler("bind_aliyun", self.handlers.bind_aliyun_command)
-        )
-        self.application.add_handler(
-            CommandHandler("unbind_aliyun", self.handlers.unbind_aliyun_command)
-        )
-        self.application.add_handler(
-            CommandHandler("list_aliyun", self.handlers.list_aliyun_command)
+        handlers = self.handlers
+        commands = (
+            ("start", handlers.start_command),
+            ("get_id", handlers.get_id_command),
+            ("bind_aliyun", handlers.bind_aliyun_command),
+            ("unbind_aliyun", handlers.unbind_aliyun_command),
+            ("list_aliyun", handlers.list_aliyun_command),
+            ("aliyun_balance", handlers.aliyun_balance_command),
+            ("set_aliyun_drop", handlers.set_aliyun_drop_command),
+            ("set_aliyun_low", handlers.set_aliyun_low_command),
+            ("monitor_status", handlers.monitor_status_command),
+            ("start_monitor", handlers.start_monitor_command),
+            ("stop_monitor", handlers.stop_monitor_command),
+            ("help", handlers.help_command),
         )
-        self.application.add_handler(
-            CommandHandler("aliyun_balance", self.handlers.aliyun_balance_command)
-        )
-        self.application.add_handler(
-            CommandHandler("set_aliyun_drop", self.handlers.set_aliyun_drop_command)
-        )
-        self.application.add_handler(
-            CommandHandler("set_aliyun_low", self.handlers.set_aliyun_low_command)
-        )
-        self.application.add_handler(
-            CommandHandler("monitor_status", self.handlers.monitor_status_command)
-        )
-        self.application.add_handler(
-            CommandHandler("start_monitor", self.handlers.start_monitor_command)
-        )
-        self.application.add_handler(
-            CommandHandler("stop_monitor", self.handlers.stop_monitor_command)
-        )
-        self.application.add_handler(CommandHandler("help", self.handlers.help_command))
+
+        # 命令处理器
+        add_handler = self.application.add_handler
+        for name, callback in commands:
+            add_handler(CommandHandler(name, callback))
 
         # 消息处理器
-        self.application.add_handler(
-            MessageHandler(
-                filters.TEXT & ~filters.COMMAND, self.handlers.handle_message
-            )
+        add_handler(
+            MessageHandler(filters.TEXT & ~filters.COMMAND, handlers.handle_message)
         )
 
         logger.info("命令处理器注册完成")
@@ -204,9 +160,14 @@ class AliyunBalanceBot:
             }
         )
 
+    def request_stop(self, signum=None):
+        """请求停止机器人（由信号处理器在事件循环中调用）"""
+        if signum is not None:
+            logger.info(f"收到信号 {signum}，正在关闭...")
+        self._stop_event.set()
+
     async def start_webhook(self):
         """启动Webhook模式"""
-        health_runner = None
         try:
             # 设置webhook，增加重试机制
             webhook_url = f"{Config.WEBHOOK_URL}/webhook"
@@ -235,14 +196,14 @@ class AliyunBalanceBot:
             app.router.add_get("/health", self.health_check)
 
             # 启动健康检查服务器（在不同端口）
-            health_runner = web.AppRunner(app)
-            await health_runner.setup()
-            health_site = web.TCPSite(health_runner, "0.0.0.0", Config.PORT + 1)
+            self._health_runner = web.AppRunner(app)
+            await self._health_runner.setup()
+            health_site = web.TCPSite(self._health_runner, "0.0.0.0", Config.PORT + 1)
             await health_site.start()
             logger.info(f"健康检查服务器启动在端口: {Config.PORT + 1}")
 
-            # 使用标准的run_webhook方法
-            await self.application.run_webhook(
+            # 在当前事件循环中启动webhook服务，不阻塞
+            await self.application.updater.start_webhook(
                 listen="0.0.0.0",
                 port=Config.PORT,
                 url_path="/webhook",
@@ -251,12 +212,6 @@ class AliyunBalanceBot:
 
         except Exception as e:
             logger.error(f"启动Webhook失败: {e}")
-            # 清理健康检查服务器
-            if health_runner:
-                try:
-                    await health_runner.cleanup()
-                except Exception as cleanup_e:
-                    logger.error(f"清理健康检查服务器失败: {cleanup_e}")
             raise
 
     async def start_polling(self):
@@ -272,8 +227,8 @@ class AliyunBalanceBot:
                     f"Webhook已删除，开始启动轮询模式 (尝试 {attempt + 1}/{max_retries})"
                 )
 
-                # 启动轮询，增加超时配置
-                await self.application.run_polling(
+                # 启动轮询，增加超时配置（在当前事件循环中运行，不阻塞）
+                await self.application.updater.start_polling(
                     allowed_updates=Update.ALL_TYPES,
                     drop_pending_updates=True,
                     poll_interval=2.0,  # 轮询间隔2秒
@@ -299,6 +254,9 @@ class AliyunBalanceBot:
         self.running = True
 
         try:
+            await self.application.initialize()
+            await self.application.start()
+
             # 启动自动监控（如果配置了）
             if Config.ENABLE_MONITORING and self.aliyun_client.is_configured():
                 await self.monitor.start_monitoring()
@@ -312,9 +270,14 @@ class AliyunBalanceBot:
                 logger.info("启动轮询模式")
                 await self.start_polling()
 
+            # 运行直到收到停止信号
+            await self._stop_event.wait()
+
         except Exception as e:
             logger.error(f"启动机器人失败: {e}")
             return False
+        finally:
+            await self.stop()
 
         return True
 
@@ -335,21 +298,40 @@ class AliyunBalanceBot:
                 except Exception as e:
                     logger.error(f"停止监控时出错: {e}")
 
-            # 停止应用
+            # 停止应用：先停止接收更新，再停止处理，最后释放网络连接
             if self.application:
                 try:
-                    # 先删除webhook
+                    if self.application.updater.running:
+                        await self.application.updater.stop()
+                    if self.application.running:
+                        await self.application.stop()
+                except Exception as e:
+                    logger.error(f"停止Telegram应用时出错: {e}")
+
+                try:
                     await self.application.bot.delete_webhook()
                     logger.info("Webhook已删除")
                 except Exception as e:
                     logger.error(f"删除Webhook时出错: {e}")
 
                 try:
-                    await self.application.stop()
                     await self.application.shutdown()
+                    # 让传输层在事件循环关闭前完成清理
+                    await asyncio.sleep(0.1)
                     logger.info("Telegram应用已停止")
                 except Exception as e:
-                    logger.error(f"停止Telegram应用时出错: {e}")
+                    logger.error(f"关闭Telegram应用时出错: {e}")
+
+            # 清理健康检查服务器
+            if self._health_runner:
+                try:
+                    await self._health_runner.cleanup()
+                except Exception as e:
+                    logger.error(f"清理健康检查服务器失败: {e}")
+
+            # 关闭数据库连接
+            if self.db:
+                self.db.close()
 
         except Exception as e:
             logger.error(f"停止机器人时出错: {e}")
@@ -361,21 +343,18 @@ class AliyunBalanceBot:
 bot_instance = None
 
 
-def signal_handler(signum, frame):
-    """信号处理器"""
-    _ = frame  # 忽略未使用的参数
-    logger.info(f"收到信号 {signum}，正在关闭...")
-    if bot_instance:
-        # 创建一个任务来停止机器人
+def install_signal_handlers(bot: AliyunBalanceBot):
+    """设置信号处理器，收到信号时只通知机器人停止，由主协程完成清理"""
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
         try:
-            loop = asyncio.get_event_loop()
-            if loop.is_running():
-                loop.create_task(bot_instance.stop())
-            else:
-                asyncio.run(bot_instance.stop())
-        except Exception as e:
-            logger.error(f"停止机器人时出错: {e}")
-    sys.exit(0)
+            loop.add_signal_handler(signum, bot.request_stop, signum)
+        except NotImplementedError:
+            # Windows事件循环不支持add_signal_handler，改用signal.signal转交给事件循环
+            signal.signal(
+                signum,
+                lambda s, _frame: loop.call_soon_threadsafe(bot.request_stop, s),
+            )
 
 
 async def main():
@@ -383,13 +362,12 @@ async def main():
     global bot_instance
 
     try:
-        # 设置信号处理器
-        signal.signal(signal.SIGINT, signal_handler)
-        signal.signal(signal.SIGTERM, signal_handler)
-
         # 创建并启动机器人
         bot_instance = AliyunBalanceBot()
 
+        # 设置信号处理器
+        install_signal_handlers(bot_instance)
+
         # 根据环境变量决定使用webhook还是polling
         # 优先使用轮询模式，除非明确配置了WEBHOOK_URL且不是Windows环境
         use_webhook = (
@@ -421,68 +399,29 @@ async def main():
 if __name__ == "__main__":
     try:
         if sys.platform == "win32":
-            # Windows环境下的特殊处理
-            asyncio.set_event_loop_policy(asyncio.WindowsProactorEventLoopPolicy())
-
-            # 创建新的事件循环而不是获取现有的
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-
+            # Windows下只使用轮询模式，Selector事件循环足够且没有Proactor传输层的关闭问题
+            asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+        elif sys.platform.startswith("linux"):
+            # Linux环境下设置事件循环策略以优化网络性能
             try:
-                success = loop.run_until_complete(main())
-            except RuntimeError as e:
-                if "Cannot close a running event loop" in str(e):
-                    logger.warning("检测到事件循环关闭问题，尝试替代方案")
-                    # 使用asyncio.run作为备选
-                    success = asyncio.run(main())
-                else:
-                    raise
-            finally:
-                try:
-                    # 安全关闭事件循环
-                    if not loop.is_closed():
-                        loop.close()
-                except Exception as close_e:
-                    logger.warning(f"关闭事件循环时出现警告: {close_e}")
-        else:
-            # Linux/Unix环境下的优化处理
-            if sys.platform.startswith("linux"):
-                # Linux环境下设置事件循环策略以优化网络性能
-                try:
-                    import uvloop  # type: ignore
+                import uvloop  # type: ignore
 
-                    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
-                    logger.info("使用uvloop事件循环以提升性能")
-                except ImportError:
-                    # 如果没有uvloop，使用默认策略但进行优化
-                    logger.info("使用默认事件循环")
+                asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+                logger.info("使用uvloop事件循环以提升性能")
+            except ImportError:
+                # 如果没有uvloop，使用默认策略但进行优化
+                logger.info("使用默认事件循环")
 
-            # 其他平台使用标准方式
-            success = asyncio.run(main())
+        # 所有平台都由 asyncio.run 创建并关闭事件循环，停止时不再重入
+        success = asyncio.run(main())
 
         if not success:
             logger.error("机器人启动失败")
             sys.exit(1)
 
     except KeyboardInterrupt:
+        # 信号处理器设置之前被中断，此时机器人尚未启动，无需清理
         logger.info("程序被用户中断")
-        if bot_instance:
-            try:
-                # 优雅关闭
-                if sys.platform == "win32":
-                    loop = asyncio.get_event_loop()
-                    if not loop.is_closed():
-                        loop.run_until_complete(bot_instance.stop())
-                else:
-                    asyncio.run(bot_instance.stop())
-            except Exception as stop_e:
-                logger.error(f"关闭机器人时出错: {stop_e}")
     except Exception as e:
         logger.error(f"程序异常退出: {e}")
-        if bot_instance:
-            try:
-                # 尝试优雅关闭
-                asyncio.run(bot_instance.stop())
-            except Exception as stop_e:
-                logger.error(f"异常关闭机器人时出错: {stop_e}")
         sys.exit(1)
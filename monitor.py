@@ -1,6 +1,7 @@
 import asyncio
 import logging
-from typing import Dict, List
+import time
+from typing import Dict, List, Optional, Tuple
 from datetime import datetime
 from database import Database
 from aliyun_client import AliyunClient
@@ -8,6 +9,13 @@ from config import Config
 
 logger = logging.getLogger(__name__)
 
+# 每轮检查时同时查询余额的最大请求数，避免触发阿里云API限流
+CHECK_CONCURRENCY = 10
+# 每检查多少轮运行一次数据库 PRAGMA optimize
+OPTIMIZE_EVERY_TICKS = 100
+# 单个账号连续查询失败后的最长退避时间（秒），不超过检查间隔时下一轮照常重试
+MAX_FAILURE_BACKOFF = 300
+
 class BalanceMonitor:
     def __init__(self, bot, db: Database, aliyun_client: AliyunClient):
         self.bot = bot
@@ -15,6 +23,12 @@ class BalanceMonitor:
         self.aliyun_client = aliyun_client
         self.monitoring = False
         self.monitor_task = None
+        self._semaphore = asyncio.Semaphore(CHECK_CONCURRENCY)
+        self._tick = 0
+        # 查询失败的账号: uid -> (连续失败次数, 下次允许重试的时间)
+        self._failures: Dict[str, Tuple[int, float]] = {}
+        # 每个账号最近一次写入余额历史的时间，用于节流历史记录
+        self._last_history_ts: Dict[str, datetime] = {}
     
     async def start_monitoring(self):
         """启动监控"""
@@ -47,60 +61,165 @@ class BalanceMonitor:
     async def _monitor_loop(self):
         """监控循环"""
         while self.monitoring:
+            self._tick += 1
             try:
                 await self._check_all_accounts()
-                await asyncio.sleep(Config.CHECK_INTERVAL)
+                if self._tick % OPTIMIZE_EVERY_TICKS == 0:
+                    await asyncio.to_thread(self.db.optimize)
             except asyncio.CancelledError:
                 break
             except Exception as e:
+                # 单个账号的失败由退避处理，这里只记录并等待下一轮
                 logger.error(f"监控循环出错: {e}")
-                await asyncio.sleep(60)  # 出错后等待1分钟再继续
+            await asyncio.sleep(Config.CHECK_INTERVAL)
     
     async def _check_all_accounts(self):
         """检查所有账号余额"""
-        accounts = self.db.get_aliyun_accounts()
+        accounts = await asyncio.to_thread(self.db.get_aliyun_accounts)
+        # 跳过仍在失败退避期内的账号
+        now = time.monotonic()
+        accounts = [
+            account for account in accounts
+            if self._failures.get(account['uid'], (0, 0.0))[1] <= now
+        ]
         if not accounts:
             return
         
         logger.info(f"开始检查 {len(accounts)} 个账号的余额")
         
-        for account in accounts:
-            try:
-                await self._check_account_balance(account)
-            except Exception as e:
-                logger.error(f"检查账号 {account['uid']} 余额失败: {e}")
+        # 先并发查询所有账号的当前余额
+        results = await asyncio.gather(
+            *(self._fetch_balance(account) for account in accounts),
+            return_exceptions=True,
+        )
+        balances = []
+        failed = []
+        for account, result in zip(accounts, results):
+            if isinstance(result, Exception):
+                logger.error(f"检查账号 {account['uid']} 余额失败: {result}")
+                failed.append(account['uid'])
+            elif result is None:
+                failed.append(account['uid'])
+            else:
+                self._failures.pop(account['uid'], None)
+                balances.append((account, result))
+        
+        # 全部失败通常是网络或限流等整体故障，不计入单个账号的退避，恢复后立即全部检查
+        if balances:
+            for uid in failed:
+                self._record_failure(uid)
+        else:
+            logger.warning(f"本轮 {len(failed)} 个账号全部查询失败，跳过失败退避")
+        
+        # 数据库写入在线程池中执行，避免SQLite的磁盘IO阻塞事件循环
+        alerts = await asyncio.to_thread(self._record_balances, balances)
+        
+        for message in alerts:
+            await self._broadcast(message)
+    
+    def _record_failure(self, uid: str):
+        """记录账号查询失败，按连续失败次数指数退避，最长 MAX_FAILURE_BACKOFF 秒"""
+        attempts = self._failures.get(uid, (0, 0.0))[0] + 1
+        delay = min(MAX_FAILURE_BACKOFF, 2 ** attempts)
+        self._failures[uid] = (attempts, time.monotonic() + delay)
+        logger.debug(f"账号 {uid} 连续失败 {attempts} 次，{delay} 秒后重试")
     
-    async def _check_account_balance(self, account: Dict):
-        """检查单个账号余额"""
+    def forget_account(self, uid: str):
+        """清除账号的失败退避和历史写入记录，在绑定或解绑账号时调用"""
+        self._failures.pop(uid, None)
+        self._last_history_ts.pop(uid, None)
+    
+    async def _fetch_balance(self, account: Dict) -> Optional[float]:
+        """获取单个账号的当前余额，失败时返回None"""
         uid = account['uid']
-        remark = account['remark']
-        low_threshold = account['low_balance_threshold']
-        drop_threshold = account['drop_threshold']
-        last_balance = account['last_balance']
-        
-        # 获取当前余额
-        credit_info = self.aliyun_client.get_credit_info(uid)
+        async with self._semaphore:
+            credit_info = await asyncio.to_thread(
+                self.aliyun_client.get_credit_info, uid, force=True
+            )
         if not credit_info or not credit_info.get('success'):
             logger.error(f"获取账号 {uid} 余额失败")
-            return
+            return None
+        return credit_info['available_credit']
+    
+    def _record_balances(self, balances: List[Tuple[Dict, float]]) -> List[str]:
+        """检查告警并在同一个事务中写入所有余额更新和告警记录，返回需要发送的告警消息
+        
+        告警只取决于查询到的余额，数据库写入失败时仍然返回告警消息。
+        """
+        now = datetime.now()
+        checked = [
+            (account, current_balance,
+             self._check_account_balance(account, current_balance, now))
+            for account, current_balance in balances
+        ]
         
-        current_balance = credit_info['available_credit']
+        history_uids = []
+        try:
+            with self.db.transaction():
+                for account, current_balance, alerts in checked:
+                    uid = account['uid']
+                    if self._save_balance(account, current_balance, now):
+                        history_uids.append(uid)
+                    for alert_type, threshold, message in alerts:
+                        self.db.record_alert(
+                            uid, alert_type, current_balance, threshold, message
+                        )
+        except Exception as e:
+            logger.error(f"写入余额记录失败: {e}")
+        else:
+            # 事务提交成功后才更新历史写入时间
+            for uid in history_uids:
+                self._last_history_ts[uid] = now
         
-        # 更新数据库中的余额
-        self.db.update_balance(uid, current_balance)
+        return [message for _, _, alerts in checked for _, _, message in alerts]
+    
+    def _save_balance(
+        self, account: Dict, current_balance: float, now: datetime
+    ) -> bool:
+        """更新账号余额，返回是否写入了余额历史
         
+        余额基本不变且最近已记录过历史时只更新最新余额。
+        """
+        uid = account['uid']
+        last_balance = account['last_balance']
+        last_history_ts = self._last_history_ts.get(uid)
+        if (
+            last_history_ts is not None
+            and abs(current_balance - last_balance) < Config.HISTORY_MIN_DELTA
+            and (now - last_history_ts).total_seconds() < Config.HISTORY_MIN_INTERVAL
+        ):
+            self.db.update_last_balance_only(uid, current_balance, now)
+            return False
+        return self.db.update_balance(uid, current_balance, now)
+    
+    def _check_account_balance(
+        self, account: Dict, current_balance: float, now: datetime
+    ) -> List[Tuple[str, float, str]]:
+        """检查单个账号的告警，返回 (告警类型, 阈值, 消息) 列表"""
+        uid = account['uid']
+        remark = account['remark']
+        low_threshold = account['low_balance_threshold']
+        drop_threshold = account['drop_threshold']
+        last_balance = account['last_balance']
+        
+        alerts = []
         # 检查低余额告警
         if current_balance <= low_threshold:
-            await self._send_low_balance_alert(account, current_balance)
+            alerts.append(self._low_balance_alert(account, current_balance, now))
         
         # 检查余额突降告警
         if last_balance > 0 and (last_balance - current_balance) >= drop_threshold:
-            await self._send_drop_alert(account, current_balance, last_balance)
+            alerts.append(
+                self._drop_alert(account, current_balance, last_balance, now)
+            )
         
         logger.debug(f"账号 {uid}({remark}) 余额检查完成: {current_balance}")
+        return alerts
     
-    async def _send_low_balance_alert(self, account: Dict, current_balance: float):
-        """发送低余额告警"""
+    def _low_balance_alert(
+        self, account: Dict, current_balance: float, now: datetime
+    ) -> Tuple[str, float, str]:
+        """生成低余额告警"""
         uid = account['uid']
         remark = account['remark']
         threshold = account['low_balance_threshold']
@@ -110,21 +229,14 @@ class BalanceMonitor:
             f"账号: {remark} ({uid})\n"
             f"当前余额: ¥{current_balance:.2f}\n"
             f"告警阈值: ¥{threshold:.2f}\n"
-            f"时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+            f"时间: {now.isoformat(sep=' ', timespec='seconds')}"
         )
-        
-        # 记录告警
-        self.db.record_alert(uid, 'low_balance', current_balance, threshold, message)
-        
-        # 发送给所有管理员
-        for admin_id in Config.ADMIN_CHAT_IDS:
-            try:
-                await self.bot.send_message(chat_id=admin_id, text=message)
-            except Exception as e:
-                logger.error(f"发送低余额告警给管理员 {admin_id} 失败: {e}")
+        return 'low_balance', threshold, message
     
-    async def _send_drop_alert(self, account: Dict, current_balance: float, last_balance: float):
-        """发送余额突降告警"""
+    def _drop_alert(
+        self, account: Dict, current_balance: float, last_balance: float, now: datetime
+    ) -> Tuple[str, float, str]:
+        """生成余额突降告警"""
         uid = account['uid']
         remark = account['remark']
         threshold = account['drop_threshold']
@@ -137,18 +249,21 @@ class BalanceMonitor:
             f"当前余额: ¥{current_balance:.2f}\n"
             f"下降金额: ¥{drop_amount:.2f}\n"
             f"告警阈值: ¥{threshold:.2f}\n"
-            f"时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+            f"时间: {now.isoformat(sep=' ', timespec='seconds')}"
         )
-        
-        # 记录告警
-        self.db.record_alert(uid, 'balance_drop', current_balance, threshold, message)
-        
-        # 发送给所有管理员
-        for admin_id in Config.ADMIN_CHAT_IDS:
-            try:
-                await self.bot.send_message(chat_id=admin_id, text=message)
-            except Exception as e:
-                logger.error(f"发送余额突降告警给管理员 {admin_id} 失败: {e}")
+        return 'balance_drop', threshold, message
+    
+    async def _broadcast(self, message: str):
+        """并发发送告警给所有管理员"""
+        # ADMIN_CHAT_IDS 是 frozenset（供 is_admin 做成员判断），这里固定一次顺序
+        admin_ids = tuple(Config.ADMIN_CHAT_IDS)
+        results = await asyncio.gather(
+            *(self.bot.send_message(chat_id=admin_id, text=message) for admin_id in admin_ids),
+            return_exceptions=True
+        )
+        for admin_id, result in zip(admin_ids, results):
+            if isinstance(result, Exception):
+                logger.error(f"发送告警给管理员 {admin_id} 失败: {result}")
     
     def is_monitoring(self) -> bool:
         """检查是否正在监控"""